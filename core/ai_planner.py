@@ -1,73 +1,104 @@
 """
 AI Planner module for generating personalized fitness plans.
-This module uses Google Gemini API for fitness plan generation.
+This module uses the async Google Gemini API for fitness plan generation.
 """
-import google.generativeai as genai
+from google import genai
+import asyncio
+import hashlib
 import os
+import time
+import weakref
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
 from dotenv import load_dotenv
+from . import semcache
+from .ratelimit import acquire_gemini_token
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Read the Gemini key once at import; a missing key stops Django at startup
+# instead of failing on the first plan
+_API_KEY = os.getenv('GEMINI_API_KEY')
+if not _API_KEY:
+    raise ImproperlyConfigured(
+        "GEMINI_API_KEY not found in .env file. Please set your Gemini API key.\n"
+        "1. Create a .env file in the project root\n"
+        "2. Add: GEMINI_API_KEY=your_api_key_here\n"
+        "3. Get your API key from: https://makersuite.google.com/app/apikey"
+    )
 
-def generate_fitness_plan_from_profile(user_profile, training_history_summary=""):
+
+class PlanRateLimited(Exception):
     """
-    Generates a personalized fitness plan based on user profile using Gemini API.
-    
-    Args:
-        user_profile: UserProfile model instance
-        training_history_summary: Optional string containing training history
-    
-    Returns:
-        str: Generated fitness plan text
+    Raised instead of calling Gemini when the shared per-minute quota is spent.
     """
-    try:
-        # 1. Configure API Key
-        api_key = os.getenv('GEMINI_API_KEY')
-        if not api_key:
-            raise ValueError("GEMINI_API_KEY not found in .env file. Please set your Gemini API key.")
-        
-        genai.configure(api_key=api_key)
-        
-        # 2. Extract user information from profile
-        user_gender = user_profile.get_gender_display() if user_profile.gender else "Not specified"
-        user_age = user_profile.age if user_profile.age else 25
-        user_height = user_profile.height_cm if user_profile.height_cm else 170
-        user_weight = user_profile.weight_kg if user_profile.weight_kg else 70
-        user_fitness_level = user_profile.get_fitness_level_display() if user_profile.fitness_level else "Beginner"
-        user_primary_goal_choice = user_profile.get_primary_goal_choice_display() if user_profile.primary_goal_choice else "General Fitness"
-        
-        # 3. Map goal choice to detailed goal
-        if "Muscle" in user_primary_goal_choice or "Gain" in user_primary_goal_choice:
-            detailed_goal = "Build lean muscle mass with a focus on hypertrophy, aiming to gain 1-2 kg of muscle."
-        elif "Fat" in user_primary_goal_choice or "Loss" in user_primary_goal_choice:
-            detailed_goal = "Lose body fat while preserving as much muscle as possible, aiming to lose 2-3 kg of fat."
-        else:
-            detailed_goal = "Improve overall fitness and health."
-        
-        # 4. Default training history if not provided
-        if not training_history_summary:
-            training_history_summary = """
-* **Workout Frequency:** Based on your fitness level, we recommend starting with 3-4 times per week.
-* **Workout Types:** A balanced mix of strength training and cardio.
-"""
-        
-        # 5. Construct the prompt (same as your original prompt engineering)
-        prompt = f"""
+    def __init__(self, message="The AI planner is handling a lot of requests right now. Please try again in a minute."):
+        super().__init__(message)
+
+
+# One Gemini client per event loop. The async HTTP pool inside a client is bound to the
+# loop that opened it, and Celery tasks (async_to_sync) run each call in a fresh loop.
+_clients = weakref.WeakKeyDictionary()
+
+
+def _client():
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = genai.Client(api_key=_API_KEY)
+    return client
+
+
+async def aclose_gemini_client():
+    """
+    Closes the running loop's Gemini client, for loops that end with the task (Celery).
+    """
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aio.aclose()
+
+# Flash models in order of preference; the first one the API key can use is picked once
+_MODEL_CANDIDATES = ('gemini-2.5-flash', 'gemini-1.5-flash')
+# (model name, monotonic time to ask the API again or None once the listing succeeded)
+_model_choice = None
+# How long a fallback picked while models.list() was failing is kept
+_MODEL_RETRY_AFTER = 5 * 60
+
+# Generated plans are cached for a week, keyed on the profile inputs of the prompt
+PLAN_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+
+# Width of the age (years), height (cm) and weight (kg) bands a semantic cache hit must share
+STAT_BAND = 5
+
+
+# Detailed goal text for each UserProfile.GOAL_CHOICES code
+_GOAL_MAP = {
+    "muscle_gain": "Build lean muscle mass with a focus on hypertrophy, aiming to gain 1-2 kg of muscle.",
+    "fat_loss": "Lose body fat while preserving as much muscle as possible, aiming to lose 2-3 kg of fat.",
+}
+_DEFAULT_GOAL = "Improve overall fitness and health."
+
+# Per-user part of the plan prompt; only the profile fields change between requests
+_PROMPT_HEADER_TMPL = """
 You are an expert AI personal trainer and nutritionist named FitTrack AI. Your task is to create a comprehensive, personalized, and actionable 4-week training and diet plan based on the user's detailed profile and recent activity. The plan should be scientific, safe, and tailored to help the user achieve their goals.
 
 ### User Profile
-* **Gender:** {user_gender}
-* **Age:** {user_age}
-* **Height:** {user_height} cm
-* **Weight:** {user_weight} kg
-* **Fitness Level:** {user_fitness_level}
-* **Primary Goal:** {detailed_goal}
+* **Gender:** {gender}
+* **Age:** {age}
+* **Height:** {height} cm
+* **Weight:** {weight} kg
+* **Fitness Level:** {fitness_level}
+* **Primary Goal:** {goal}
 
 ### Recent Training History (Summary of the last month)
-{training_history_summary}
+{training_history}
 
-### Your Task: Generate the 4-Week Plan
+"""
+
+# Task specification shared by every plan prompt, kept as one constant string
+_PROMPT_STATIC_TAIL = """### Your Task: Generate the 4-Week Plan
 
 Based on all the information provided, generate a detailed 4-week plan.
 
@@ -87,25 +118,242 @@ Based on all the information provided, generate a detailed 4-week plan.
 
 Please generate the complete, detailed plan now.
 """
+
+
+def _plan_cache_key(gender, age, height, weight, level, goal, history):
+    digest = hashlib.sha256(f"{gender}|{age}|{height}|{weight}|{level}|{goal}|{history}".encode()).hexdigest()
+    return 'plan:' + digest
+
+
+def _user_plan_keys_key(user_id):
+    return f"plan-keys:{user_id}"
+
+
+def forget_cached_plans(user_id):
+    """
+    Drops every cached plan that was generated for the given user.
+    """
+    keys_key = _user_plan_keys_key(user_id)
+    keys = cache.get(keys_key) or set()
+    cache.delete_many([*keys, keys_key])
+
+
+def _build_prompt(user_profile, training_history_summary=""):
+    """
+    Builds the Gemini prompt for a profile.
+    
+    Returns:
+        tuple: (plan cache key, semantic cache namespace, (age, height, weight), full prompt text)
+    """
+    # 1. Extract user information from profile
+    user_gender = user_profile.get_gender_display() if user_profile.gender else "Not specified"
+    user_age = user_profile.age if user_profile.age else 25
+    user_height = user_profile.height_cm if user_profile.height_cm else 170
+    user_weight = user_profile.weight_kg if user_profile.weight_kg else 70
+    user_fitness_level = user_profile.get_fitness_level_display() if user_profile.fitness_level else "Beginner"
+    
+    # 2. Map goal choice to detailed goal
+    detailed_goal = _GOAL_MAP.get(user_profile.primary_goal_choice, _DEFAULT_GOAL)
+    
+    # 3. Default training history if not provided
+    if not training_history_summary:
+        training_history_summary = """
+* **Workout Frequency:** Based on your fitness level, we recommend starting with 3-4 times per week.
+* **Workout Types:** A balanced mix of strength training and cardio.
+"""
+    
+    # 4. Key the plan cache on exactly the inputs that enter the prompt
+    cache_key = _plan_cache_key(
+        user_gender, user_age, user_height, user_weight,
+        user_fitness_level, detailed_goal, training_history_summary,
+    )
+    # Only prompts that agree on everything and have body stats in the same narrow bands may share a plan
+    stat_bands = f"{int(user_age // STAT_BAND)}|{int(user_height // STAT_BAND)}|{int(user_weight // STAT_BAND)}"
+    namespace = f"{user_gender}|{user_fitness_level}|{detailed_goal}|{training_history_summary}|{stat_bands}"
+    
+    # 5. Fill in the per-user header and append the shared task (same as your original prompt engineering)
+    header = _PROMPT_HEADER_TMPL.format_map({
+        'gender': user_gender,
+        'age': user_age,
+        'height': user_height,
+        'weight': user_weight,
+        'fitness_level': user_fitness_level,
+        'goal': detailed_goal,
+        'training_history': training_history_summary,
+    })
+    prompt = header + _PROMPT_STATIC_TAIL
+    
+    return cache_key, namespace, (user_age, user_height, user_weight), prompt
+
+
+async def _aget_model_name():
+    """
+    Returns the best available flash model, asking the API only until it answers once.
+    """
+    global _model_choice
+    if _model_choice is not None:
+        name, retry_at = _model_choice
+        if retry_at is None or time.monotonic() < retry_at:
+            return name
+    try:
+        available = {m.name.removeprefix('models/') async for m in await _client().aio.models.list()}
+    except Exception:
+        # Assume the preferred model exists and only ask again after a while
+        _model_choice = (_MODEL_CANDIDATES[0], time.monotonic() + _MODEL_RETRY_AFTER)
+        return _MODEL_CANDIDATES[0]
+    name = next((name for name in _MODEL_CANDIDATES if name in available), _MODEL_CANDIDATES[0])
+    _model_choice = (name, None)
+    return name
+
+
+async def _find_cached_plan(cache_key, namespace, stats):
+    """
+    Looks for a plan in the exact cache first, then in the semantic cache.
+    
+    Returns:
+        tuple: (cached plan text or None, whether it came from the semantic cache)
+    """
+    cached = await cache.aget(cache_key)
+    if cached:
+        return cached, False
+    return await semcache.alookup(namespace, stats), True
+
+
+async def _remember_plan(user_id, cache_key, result_text, namespace=None, stats=None):
+    # Write through to the cache and remember the key for invalidation
+    await cache.aset(cache_key, result_text, PLAN_CACHE_TIMEOUT)
+    keys_key = _user_plan_keys_key(user_id)
+    user_keys = await cache.aget(keys_key) or set()
+    user_keys.add(cache_key)
+    await cache.aset(keys_key, user_keys, PLAN_CACHE_TIMEOUT)
+    if namespace is not None:
+        await semcache.astore(namespace, stats, result_text)
+
+
+_EMPTY_PLAN_TEXT = "Gemini returned an empty plan (the response may have been blocked). Please try again."
+
+
+def _api_error_text(e):
+    error_type = type(e).__name__
+    return f"Error generating plan ({error_type}): {str(e)}\n\nPlease check:\n1. Your internet connection\n2. Your Gemini API key is valid\n3. You have API quota remaining"
+
+
+async def agenerate_fitness_plan_from_profile(user_profile, training_history_summary=""):
+    """
+    Generates a personalized fitness plan based on user profile using Gemini API.
+    The Gemini call is awaited, so the worker is free while the request is in flight.
+    
+    Args:
+        user_profile: UserProfile model instance
+        training_history_summary: Optional string containing training history
+    
+    Returns:
+        str: Generated fitness plan text
+    
+    Raises:
+        PlanRateLimited: If the plan isn't cached and the Gemini quota is spent
+    """
+    try:
+        # 1. Return a cached plan for these (or near-identical) inputs
+        cache_key, namespace, stats, prompt = _build_prompt(user_profile, training_history_summary)
+        cached, shared = await _find_cached_plan(cache_key, namespace, stats)
+        if cached:
+            if shared:
+                await _remember_plan(user_profile.user_id, cache_key, cached)
+            return cached
         
-        # 6. Call the Generative AI Model (Gemini)
-        # Try gemini-2.5-flash first, fallback to gemini-1.5-flash if not available
-        try:
-            model = genai.GenerativeModel('gemini-2.5-flash')
-        except Exception:
-            # Fallback to gemini-1.5-flash if 2.5 is not available
-            model = genai.GenerativeModel('gemini-1.5-flash')
+        # 2. Take a token from the shared Gemini quota; cache hits above never spend one
+        if not await acquire_gemini_token():
+            raise PlanRateLimited()
         
-        response = model.generate_content(prompt)
+        # 3. Call the Generative AI Model (Gemini) without blocking the event loop
+        response = await _client().aio.models.generate_content(
+            model=await _aget_model_name(),
+            contents=prompt,
+        )
         result_text = response.text
+        if not result_text:
+            # Nothing to cache, e.g. the response was blocked by a safety filter
+            return _EMPTY_PLAN_TEXT
         
+        await _remember_plan(user_profile.user_id, cache_key, result_text, namespace, stats)
         return result_text
         
-    except ValueError as ve:
-        # API key or configuration error
-        return f"Configuration Error: {str(ve)}\n\nPlease check:\n1. Create a .env file in the project root\n2. Add: GEMINI_API_KEY=your_api_key_here\n3. Get your API key from: https://makersuite.google.com/app/apikey"
+    except PlanRateLimited:
+        raise
     except Exception as e:
         # Other errors (API errors, network errors, etc.)
-        error_type = type(e).__name__
-        return f"Error generating plan ({error_type}): {str(e)}\n\nPlease check:\n1. Your internet connection\n2. Your Gemini API key is valid\n3. You have API quota remaining"
+        return _api_error_text(e)
+
+
+async def astream_fitness_plan_from_profile(user_profile, training_history_summary=""):
+    """
+    Streams a personalized fitness plan from Gemini as it is generated.
+    
+    Args:
+        user_profile: UserProfile model instance
+        training_history_summary: Optional string containing training history
+    
+    Yields:
+        str: Successive pieces of the plan text (or an error message)
+    
+    Raises:
+        PlanRateLimited: If the plan isn't cached and the Gemini quota is spent
+    """
+    try:
+        cache_key, namespace, stats, prompt = _build_prompt(user_profile, training_history_summary)
+        cached, shared = await _find_cached_plan(cache_key, namespace, stats)
+        if cached:
+            if shared:
+                await _remember_plan(user_profile.user_id, cache_key, cached)
+            yield cached
+            return
+        
+        if not await acquire_gemini_token():
+            raise PlanRateLimited()
+        
+        parts = []
+        stream = await _client().aio.models.generate_content_stream(
+            model=await _aget_model_name(),
+            contents=prompt,
+        )
+        async for chunk in stream:
+            if chunk.text:
+                parts.append(chunk.text)
+                yield chunk.text
+        
+        # Only a fully streamed, non-empty plan is worth caching
+        if not parts:
+            yield _EMPTY_PLAN_TEXT
+            return
+        await _remember_plan(user_profile.user_id, cache_key, "".join(parts), namespace, stats)
+        
+    except PlanRateLimited:
+        raise
+    except Exception as e:
+        yield _api_error_text(e)
+
+
+async def agenerate_many(profiles, concurrency=10):
+    """
+    Generates plans for several profiles at once, with at most `concurrency` Gemini calls in flight.
+    
+    Args:
+        profiles: Iterable of UserProfile model instances
+        concurrency: Maximum number of simultaneous Gemini requests
+    
+    Returns:
+        list: Generated plan texts, in the same order as `profiles`
+    """
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(profile):
+        async with sem:
+            while True:
+                try:
+                    return await agenerate_fitness_plan_from_profile(profile)
+                except PlanRateLimited:
+                    # Bulk runs wait for the bucket to refill instead of failing
+                    await asyncio.sleep(60 / settings.GEMINI_REQUESTS_PER_MINUTE)
 
+    return await asyncio.gather(*[one(p) for p in profiles])
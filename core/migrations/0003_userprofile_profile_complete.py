@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-15 02:56
+
+from django.db import migrations, models
+
+
+def backfill_profile_complete(apps, schema_editor):
+    UserProfile = apps.get_model("core", "UserProfile")
+    UserProfile.objects.exclude(gender="").filter(
+        age__isnull=False, age__gt=0, height_cm__isnull=False, weight_kg__isnull=False
+    ).exclude(height_cm=0).exclude(weight_kg=0).update(profile_complete=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0002_userprofile_delete_dailymetric"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="userprofile",
+            name="profile_complete",
+            field=models.BooleanField(db_index=True, default=False, editable=False),
+        ),
+        migrations.RunPython(backfill_profile_complete, migrations.RunPython.noop),
+    ]
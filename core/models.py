@@ -1,5 +1,12 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.core.cache import cache
+
+# Profiles are read on most pages; signals drop the cached copy on save/delete
+PROFILE_CACHE_TIMEOUT = 60 * 60
+
+# The only profile columns the AI planner reads
+PLANNER_PROFILE_FIELDS = ("gender", "age", "height_cm", "weight_kg", "fitness_level", "primary_goal_choice", "profile_complete")
 
 
 class UserProfile(models.Model):
@@ -30,8 +37,56 @@ class UserProfile(models.Model):
     weight_kg = models.FloatField(null=True, blank=True)
     fitness_level = models.CharField(max_length=16, choices=FITNESS_LEVEL_CHOICES, blank=True)
     primary_goal_choice = models.CharField(max_length=32, choices=GOAL_CHOICES, blank=True)
+    # Whether the fields the AI planner requires are filled in; kept up to date by save()
+    profile_complete = models.BooleanField(default=False, db_index=True, editable=False)
+
+    def save(self, *args, **kwargs):
+        self.profile_complete = bool(self.gender and self.age and self.height_cm and self.weight_kg)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None:
+            kwargs["update_fields"] = {*update_fields, "profile_complete"}
+        super().save(*args, **kwargs)
 
     def __str__(self) -> str:
         return f"Profile of {self.user.username}"
 
+
+def profile_cache_key(user_id):
+    return f"profile:{user_id}"
+
+
+def get_cached_profile(user):
+    """
+    Returns the user's profile from the cache, creating it on first access.
+    """
+    return cache.get_or_set(
+        profile_cache_key(user.id),
+        lambda: UserProfile.objects.get_or_create(user=user)[0],
+        PROFILE_CACHE_TIMEOUT,
+    )
+
+
+def remember_profile(profile):
+    """
+    Writes a freshly saved profile back to the cache so the next page skips the DB.
+    """
+    cache.set(profile_cache_key(profile.user_id), profile, PROFILE_CACHE_TIMEOUT)
+
+
+def planner_profile_cache_key(user_id):
+    return f"profile:{user_id}:planner"
+
+
+async def aget_planner_profile(user):
+    """
+    Returns the user's profile for the async AI planner views, loading only PLANNER_PROFILE_FIELDS.
+    It is cached apart from the full row so profile_edit never sees a partial instance.
+    """
+    key = planner_profile_cache_key(user.id)
+    profile = await cache.aget(key)
+    if profile is None:
+        profile, _ = await UserProfile.objects.only("user", *PLANNER_PROFILE_FIELDS).aget_or_create(user=user)
+        await cache.aset(key, profile, PROFILE_CACHE_TIMEOUT)
+    return profile
+
 # Create your models here.
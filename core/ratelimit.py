@@ -0,0 +1,144 @@
+"""
+Rate limiting for Gemini API calls.
+A single token bucket lives in Redis so every worker draws from the same per-minute quota,
+and sorted sets cap how many plans are generating at once, per user and site-wide.
+Without REDIS_URL (a single local process) the limiters are skipped.
+"""
+import asyncio
+import logging
+import time
+import weakref
+
+import redis.asyncio as redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+BUCKET_KEY = "gemini:bucket"
+ACTIVE_KEY = "gemini:active"
+
+# Slots older than this are treated as abandoned (a crashed worker never released them)
+SLOT_TIMEOUT = 300
+
+# Refills the bucket for the elapsed time and takes one token, atomically.
+# KEYS[1] = bucket key, ARGV = capacity, refill rate (tokens/sec), now (sec)
+LUA_TOKEN_BUCKET = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) * 2)
+return allowed
+"""
+
+# Drops stale slots, then takes one in both the user's set and the global set if both have room.
+# KEYS[1] = user's set, KEYS[2] = global set
+# ARGV = request id, now (sec), slot timeout (sec), per-user limit, global limit
+LUA_CONCURRENCY = """
+local now = tonumber(ARGV[2])
+local stale = now - tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', stale)
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', stale)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[4]) or redis.call('ZCARD', KEYS[2]) >= tonumber(ARGV[5]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now, ARGV[1])
+redis.call('ZADD', KEYS[2], now, ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return 1
+"""
+
+
+# One Redis client per event loop, like ai_planner._client(); its connection pool is bound
+# to the loop that opened it
+_clients = weakref.WeakKeyDictionary()
+
+
+def _client():
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = redis.from_url(settings.REDIS_URL)
+    return client
+
+
+async def aclose_redis_client():
+    """
+    Closes the running loop's Redis client, if the limiters opened one.
+    """
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def _user_active_key(user_id):
+    return f"gemini:active:{user_id}"
+
+
+async def acquire_gemini_token():
+    """
+    Takes one token from the shared Gemini bucket.
+
+    Returns:
+        bool: True if the caller may call Gemini now, False if the quota is spent
+    """
+    if not settings.REDIS_URL:
+        return True
+    capacity = settings.GEMINI_REQUESTS_PER_MINUTE
+    rate = capacity / 60
+    try:
+        allowed = await _client().eval(LUA_TOKEN_BUCKET, 1, BUCKET_KEY, capacity, rate, time.time())
+    except redis.RedisError:
+        # Don't take the planner down with Redis; Gemini's own quota still applies
+        logger.warning("Gemini rate limiter unavailable, allowing request", exc_info=True)
+        return True
+    return bool(allowed)
+
+
+async def acquire_generation_slot(user_id, req_id):
+    """
+    Claims a plan-generation slot for one request.
+
+    Args:
+        user_id: ID of the user asking for a plan
+        req_id: Unique id for this request, passed back to release_generation_slot
+
+    Returns:
+        bool: True if the plan may be generated, False if the user (or site) is at its limit
+    """
+    if not settings.REDIS_URL:
+        return True
+    try:
+        allowed = await _client().eval(
+            LUA_CONCURRENCY, 2, _user_active_key(user_id), ACTIVE_KEY,
+            req_id, time.time(), SLOT_TIMEOUT,
+            settings.PLAN_GENERATIONS_PER_USER, settings.PLAN_GENERATIONS_TOTAL,
+        )
+    except redis.RedisError:
+        logger.warning("Plan concurrency limiter unavailable, allowing request", exc_info=True)
+        return True
+    return bool(allowed)
+
+
+async def release_generation_slot(user_id, req_id):
+    """
+    Frees the slot taken by acquire_generation_slot.
+    """
+    if not settings.REDIS_URL:
+        return
+    try:
+        async with _client().pipeline(transaction=True) as pipe:
+            await pipe.zrem(_user_active_key(user_id), req_id).zrem(ACTIVE_KEY, req_id).execute()
+    except redis.RedisError:
+        # The slot expires on its own after SLOT_TIMEOUT
+        logger.warning("Could not release plan generation slot", exc_info=True)
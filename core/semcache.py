@@ -0,0 +1,65 @@
+"""
+Shared cache for AI plans.
+Prompts that are nearly the same (same gender, level, goal and history, body stats in the same
+narrow bands) reuse an earlier plan instead of calling Gemini again. The namespace alone decides
+a hit, so a lookup is a single cache read.
+
+Plans usually restate the body stats they were written for, so a shared plan has the original
+user's age, height and weight rewritten to the requester's. Calorie and macro targets are left
+as generated; within one 5-unit band they are off by a few percent at most.
+"""
+import hashlib
+import re
+
+from django.core.cache import cache
+
+SEMCACHE_TIMEOUT = 60 * 60 * 24 * 7
+
+
+def _entries_key(namespace):
+    return 'semcache:' + hashlib.sha256(namespace.encode()).hexdigest()
+
+
+def _number(value):
+    # Matches 84, 84.0 and 84.50 alike
+    return re.escape(f"{float(value):g}") + r"(?:\.0+)?"
+
+
+def _restate_stats(plan, source, target):
+    """
+    Replaces the (age, height, weight) a plan was written for with another user's.
+    """
+    (src_age, src_height, src_weight), (age, height, weight) = source, target
+    patterns = (
+        (rf"\b{_number(src_age)}(?=[- ]?(?:years?|yrs?|yo)\b)", age),
+        (rf"\b{_number(src_height)}(?=\s?cm\b)", height),
+        (rf"\b{_number(src_weight)}(?=\s?kg\b)", weight),
+    )
+    for pattern, value in patterns:
+        plan = re.sub(pattern, f"{float(value):g}", plan)
+    return plan
+
+
+async def alookup(namespace, stats):
+    """
+    Finds the plan stored for a namespace.
+
+    Args:
+        namespace: Semantic cache namespace from ai_planner._build_prompt
+        stats: (age, height, weight) of the user asking
+
+    Returns:
+        str: The cached plan restated for `stats`, or None
+    """
+    entry = await cache.aget(_entries_key(namespace))
+    if entry is None:
+        return None
+    source, plan = entry
+    return _restate_stats(plan, source, stats)
+
+
+async def astore(namespace, stats, plan):
+    """
+    Stores a generated plan for its namespace, replacing any earlier one.
+    """
+    await cache.aset(_entries_key(namespace), (stats, plan), SEMCACHE_TIMEOUT)
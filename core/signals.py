@@ -0,0 +1,16 @@
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .models import UserProfile, planner_profile_cache_key, profile_cache_key
+from .ai_planner import forget_cached_plans
+
+
+@receiver(post_save, sender=UserProfile)
+def invalidate_cached_plans(sender, instance, **kwargs):
+    forget_cached_plans(instance.user_id)
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def invalidate_cached_profile(sender, instance, **kwargs):
+    cache.delete_many([profile_cache_key(instance.user_id), planner_profile_cache_key(instance.user_id)])
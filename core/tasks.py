@@ -0,0 +1,26 @@
+from asgiref.sync import async_to_sync
+from celery import shared_task
+from .models import UserProfile
+from .ai_planner import aclose_gemini_client, agenerate_fitness_plan_from_profile
+from .ratelimit import aclose_redis_client, release_generation_slot
+
+
+async def _agenerate_plan(profile_id, user_id, req_id):
+    # The whole task runs in one event loop, whose clients are closed before it goes away
+    try:
+        # Look the profile up in here so the slot is freed even if it was deleted meanwhile
+        profile = await UserProfile.objects.aget(id=profile_id)
+        return await agenerate_fitness_plan_from_profile(profile)
+    finally:
+        await release_generation_slot(user_id, req_id)
+        await aclose_gemini_client()
+        await aclose_redis_client()
+
+
+@shared_task
+def generate_plan_task(profile_id, user_id, req_id):
+    """
+    Generates the AI plan for a profile on a Celery worker.
+    Frees the generation slot the view claimed for `user_id` under `req_id` once done.
+    """
+    return async_to_sync(_agenerate_plan)(profile_id, user_id, req_id)
@@ -1,3 +1,230 @@
+import importlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.test import TestCase
+from google import genai
+
+from . import ai_planner, semcache
+from .models import UserProfile, planner_profile_cache_key, profile_cache_key
+from .tasks import generate_plan_task
+
+
+class _StubGeminiHandler(BaseHTTPRequestHandler):
+    # Answers models.list and generateContent like the Gemini API.
+    # Keep-alive lets the client pool connections, which is what ties them to an event loop.
+    protocol_version = 'HTTP/1.1'
+
+    def _send_json(self, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if ':generateContent' not in self.path:
+            self.send_error(404)
+            return
+        self._send_json({'candidates': [{'content': {'role': 'model', 'parts': [{'text': 'PLAN'}]}}]})
+
+    def do_GET(self):
+        self._send_json({'models': [{'name': 'models/gemini-2.5-flash'}]})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class GeneratePlanTaskTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), _StubGeminiHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        ai_planner._model_choice = None
+        user = User.objects.create_user('runner', password='pw')
+        self.profile = UserProfile.objects.create(
+            user=user, gender='male', age=30, height_cm=180, weight_kg=80,
+        )
+        base_url = f"http://127.0.0.1:{self.server.server_port}/"
+        self.release_slot = mock.AsyncMock()
+        real_client = genai.Client
+        patches = [
+            mock.patch.object(
+                ai_planner.genai, 'Client',
+                lambda **kwargs: real_client(http_options={'base_url': base_url}, **kwargs),
+            ),
+            mock.patch.object(ai_planner, 'acquire_gemini_token', mock.AsyncMock(return_value=True)),
+            mock.patch('core.tasks.release_generation_slot', self.release_slot),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_each_run_gets_a_working_client(self):
+        # Every task runs in a new event loop; a client reused across loops fails on the second run
+        for _ in range(3):
+            cache.clear()
+            self.assertEqual(generate_plan_task(self.profile.id, self.profile.user_id, 'req'), 'PLAN')
+
+    def test_slot_is_released_when_profile_is_gone(self):
+        profile_id, user_id = self.profile.id, self.profile.user_id
+        self.profile.delete()
+        with self.assertRaises(UserProfile.DoesNotExist):
+            generate_plan_task(profile_id, user_id, 'req')
+        self.release_slot.assert_awaited_once_with(user_id, 'req')
+
+
+class SemanticNamespaceTests(TestCase):
+    def _namespace(self, **stats):
+        fields = {'gender': 'male', 'age': 30, 'height_cm': 180, 'weight_kg': 80, **stats}
+        return ai_planner._build_prompt(UserProfile(**fields))[1]
+
+    def test_close_stats_share_a_namespace(self):
+        self.assertEqual(self._namespace(weight_kg=80), self._namespace(weight_kg=81))
+
+    def test_distant_stats_never_share_a_plan(self):
+        self.assertNotEqual(self._namespace(weight_kg=55), self._namespace(weight_kg=110))
+        self.assertNotEqual(self._namespace(age=25), self._namespace(age=55))
+        self.assertNotEqual(self._namespace(height_cm=160), self._namespace(height_cm=190))
+
+
+class SharedPlanTests(TestCase):
+    def test_shared_plan_restates_requesters_stats(self):
+        plan = "For a 34-year-old at 180 cm and 84.0 kg: 3 sets of 8 reps."
+        async_to_sync(semcache.astore)('ns', (34, 180.0, 84.0), plan)
+        self.assertEqual(
+            async_to_sync(semcache.alookup)('ns', (33, 182.0, 82.5)),
+            "For a 33-year-old at 182 cm and 82.5 kg: 3 sets of 8 reps.",
+        )
+
+
+class EmptyPlanTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user('empty', password='pw')
+        self.profile = UserProfile.objects.create(
+            user=user, gender='female', age=40, height_cm=165, weight_kg=60,
+        )
+        patches = [
+            mock.patch.object(ai_planner, '_aget_model_name', mock.AsyncMock(return_value='gemini-2.5-flash')),
+            mock.patch.object(ai_planner, 'acquire_gemini_token', mock.AsyncMock(return_value=True)),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_blocked_response_is_not_cached(self):
+        generate = mock.AsyncMock(return_value=mock.Mock(text=None))
+        with mock.patch('google.genai.models.AsyncModels.generate_content', generate):
+            first = async_to_sync(ai_planner.agenerate_fitness_plan_from_profile)(self.profile)
+        self.assertEqual(first, ai_planner._EMPTY_PLAN_TEXT)
+
+        generate = mock.AsyncMock(return_value=mock.Mock(text='PLAN'))
+        with mock.patch('google.genai.models.AsyncModels.generate_content', generate):
+            second = async_to_sync(ai_planner.agenerate_fitness_plan_from_profile)(self.profile)
+        self.assertEqual(second, 'PLAN')
+
+    def test_empty_stream_is_not_cached(self):
+        async def no_chunks():
+            return
+            yield
+
+        async def collect():
+            return [text async for text in ai_planner.astream_fitness_plan_from_profile(self.profile)]
+
+        stream = mock.AsyncMock(return_value=no_chunks())
+        with mock.patch('google.genai.models.AsyncModels.generate_content_stream', stream):
+            self.assertEqual(async_to_sync(collect)(), [ai_planner._EMPTY_PLAN_TEXT])
+        cache_key = ai_planner._build_prompt(self.profile)[0]
+        self.assertIsNone(cache.get(cache_key))
+
+
+class ModelChoiceTests(TestCase):
+    def setUp(self):
+        ai_planner._model_choice = None
+        self.addCleanup(setattr, ai_planner, '_model_choice', None)
+
+    def test_fallback_is_remembered_until_retry_window_ends(self):
+        listing = mock.AsyncMock(side_effect=RuntimeError('unavailable'))
+        with mock.patch('google.genai.models.AsyncModels.list', listing), \
+                mock.patch.object(ai_planner.time, 'monotonic', return_value=1000.0) as monotonic:
+            self.assertEqual(async_to_sync(ai_planner._aget_model_name)(), 'gemini-2.5-flash')
+            self.assertEqual(async_to_sync(ai_planner._aget_model_name)(), 'gemini-2.5-flash')
+            self.assertEqual(listing.await_count, 1)
+
+            monotonic.return_value += ai_planner._MODEL_RETRY_AFTER
+            async_to_sync(ai_planner._aget_model_name)()
+            self.assertEqual(listing.await_count, 2)
+
+
+class ProfileCompleteTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('complete', password='pw')
+
+    def test_save_sets_flag(self):
+        profile = UserProfile.objects.create(user=self.user, gender='male', age=30, height_cm=180, weight_kg=80)
+        self.assertTrue(UserProfile.objects.get(pk=profile.pk).profile_complete)
+
+        profile.weight_kg = None
+        profile.save()
+        self.assertFalse(UserProfile.objects.get(pk=profile.pk).profile_complete)
+
+    def test_save_with_update_fields_updates_flag(self):
+        profile = UserProfile.objects.create(user=self.user, gender='male', height_cm=180, weight_kg=80)
+        self.assertFalse(profile.profile_complete)
+
+        profile.age = 30
+        profile.save(update_fields=['age'])
+        self.assertTrue(UserProfile.objects.get(pk=profile.pk).profile_complete)
+
+    def test_backfill_marks_only_complete_profiles(self):
+        migration = importlib.import_module('core.migrations.0003_userprofile_profile_complete')
+        other = User.objects.create_user('incomplete', password='pw')
+        complete = UserProfile.objects.create(user=self.user, gender='female', age=25, height_cm=170, weight_kg=60)
+        incomplete = UserProfile.objects.create(user=other, gender='female', age=25, height_cm=0, weight_kg=60)
+        UserProfile.objects.update(profile_complete=False)
+
+        migration.backfill_profile_complete(apps, None)
+
+        self.assertTrue(UserProfile.objects.get(pk=complete.pk).profile_complete)
+        self.assertFalse(UserProfile.objects.get(pk=incomplete.pk).profile_complete)
+
+
+class ProfileCacheInvalidationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('cached', password='pw')
+        self.profile = UserProfile.objects.create(user=self.user, gender='male', age=30, height_cm=180, weight_kg=80)
+        self.keys = [profile_cache_key(self.user.id), planner_profile_cache_key(self.user.id), 'plan:abc']
+        cache.set_many({key: 'cached' for key in self.keys})
+        cache.set(ai_planner._user_plan_keys_key(self.user.id), {'plan:abc'})
+
+    def assertCacheDropped(self):
+        self.assertEqual(cache.get_many([*self.keys, ai_planner._user_plan_keys_key(self.user.id)]), {})
+
+    def test_save_drops_cached_profile_and_plans(self):
+        self.profile.weight_kg = 78
+        self.profile.save()
+        self.assertCacheDropped()
 
-# Create your tests here.
+    def test_delete_drops_cached_profile(self):
+        self.profile.delete()
+        self.assertEqual(cache.get_many(self.keys[:2]), {})
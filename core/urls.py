@@ -12,6 +12,8 @@ urlpatterns = [
     path('import/', views.import_csv, name='import_csv'),
     path('dashboard/', views.dashboard, name='dashboard'),
     path('ai-planner/', views.ai_planner, name='ai_planner'),
+    path('ai-planner/stream/', views.ai_planner_stream, name='ai_planner_stream'),
+    path('ai-planner/status/<str:task_id>/', views.ai_planner_status, name='ai_planner_status'),
 ]
 
 
@@ -1,12 +1,39 @@
+import secrets
+from types import MappingProxyType
 from django.shortcuts import render, redirect
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import authenticate, login as auth_login, logout as auth_logout
 from django.contrib.auth.models import User
 from django.contrib import messages
-from .models import UserProfile
+from .models import aget_planner_profile, get_cached_profile, remember_profile
 from .forms import UserProfileForm
-from django.views.decorators.cache import never_cache
-from .ai_planner import generate_fitness_plan_from_profile
+from django.views.decorators.cache import cache_control, cache_page, never_cache
+from django.views.decorators.vary import vary_on_cookie
+from asgiref.sync import sync_to_async
+from .ai_planner import PlanRateLimited, astream_fitness_plan_from_profile
+from .ratelimit import acquire_generation_slot, release_generation_slot
+from .tasks import generate_plan_task
+
+
+# Exercise library shown on the exercises page; built once, shared read-only by every request
+_EXERCISES = tuple(MappingProxyType(item) for item in (
+    {"key": "pushup", "name": "Push-up", "desc": "Keep a straight line from head to heels; lower chest near floor; elbows ~45°.", "youtube_id": "I9fsqKE5XHo"},
+    {"key": "situp", "name": "Sit-up", "desc": "Engage core to lift torso; avoid pulling with neck or lower back.", "youtube_id": "pCX65Mtc_Kk"},
+    {"key": "squat", "name": "Squat", "desc": "Hips back, knees track over toes (not far past); spine neutral.", "youtube_id": "2t3Ab7a2ZM4"},
+    {"key": "bench", "name": "Bench Press", "desc": "Stable chest/shoulders/elbows; bar path vertically down and up.", "youtube_id": "hWbUlkb5Ms4"},
+    {"key": "deadlift", "name": "Deadlift", "desc": "Flat back; coordinate knees and hips; bar travels close to legs.", "youtube_id": "ZaTM37cfiDs"},
+    {"key": "plank", "name": "Plank", "desc": "Body in a straight line; avoid hips too high or sagging.", "youtube_id": "6LqqeBtFn9M"},
+    {"key": "pullup", "name": "Pull-up", "desc": "Control the rhythm up and down; use assisted variations if needed.", "youtube_id": "eGo4IYlbE5g"},
+    {"key": "lunges", "name": "Lunges", "desc": "Front and back knee at safe angles; front knee not beyond toes.", "youtube_id": "1LuRcKJMn8w"},
+    {"key": "burpee", "name": "Burpee", "desc": "Combine squat, push-up, and jump in a smooth sequence.", "youtube_id": "NCqbpkoiyXE"},
+    {"key": "climbers", "name": "Mountain Climbers", "desc": "Fast and stable pace; use core to control body.", "youtube_id": "cnyTQDSE884"},
+    {"key": "jumprope", "name": "Jump Rope", "desc": "Use wrists to turn rope; light on toes with quick rebounds.", "youtube_id": "wqN5bRkZPK0"},
+    {"key": "rowing", "name": "Rowing Machine", "desc": "Drive sequence: legs → body → arms; recover in reverse order.", "youtube_id": "ZN0J6qKCIrI"},
+))
+
+
+_PLAN_ALREADY_GENERATING = "Your plan is already being generated. Please wait for it to finish."
 
 
 @never_cache
@@ -14,21 +41,28 @@ def home(request):
     return render(request, 'home.html')
 
 
+# Pages without per-user data are cached; the nav depends on login state, so vary on the cookie
+@cache_page(60 * 60)
+@vary_on_cookie
 def add_data(request):
     return render(request, 'add_data.html')
 
 
+@cache_page(60 * 60)
+@vary_on_cookie
 def import_csv(request):
     return render(request, 'import_csv.html')
 
 
+@cache_page(60 * 60)
+@vary_on_cookie
 def dashboard(request):
     return render(request, 'dashboard.html')
 
 
 @login_required
 def profile_view(request):
-    profile, _ = UserProfile.objects.get_or_create(user=request.user)
+    profile = get_cached_profile(request.user)
     return render(request, 'profile.html', {"profile": profile})
 
 
@@ -38,11 +72,13 @@ def profile_edit(request):
     if not request.user.is_authenticated:
         return redirect('login')
     
-    profile, _ = UserProfile.objects.get_or_create(user=request.user)
+    profile = get_cached_profile(request.user)
     if request.method == 'POST':
         form = UserProfileForm(request.POST, request.FILES, instance=profile)
         if form.is_valid():
-            form.save()
+            profile = form.save()
+            # Keep redirect-after-POST, but let the profile page read the saved row from cache
+            remember_profile(profile)
             messages.success(request, 'Profile updated successfully!')
             # Use reverse to get the URL, or direct path
             return redirect('profile')
@@ -71,52 +107,118 @@ def logout_view(request):
     return redirect('/')
 
 @login_required
+@cache_control(private=True)
+@cache_page(60 * 60 * 24)
+@vary_on_cookie
 def exercises(request):
-    items = [
-        {"key": "pushup", "name": "Push-up", "desc": "Keep a straight line from head to heels; lower chest near floor; elbows ~45°.", "youtube_id": "I9fsqKE5XHo"},
-        {"key": "situp", "name": "Sit-up", "desc": "Engage core to lift torso; avoid pulling with neck or lower back.", "youtube_id": "pCX65Mtc_Kk"},
-        {"key": "squat", "name": "Squat", "desc": "Hips back, knees track over toes (not far past); spine neutral.", "youtube_id": "2t3Ab7a2ZM4"},
-        {"key": "bench", "name": "Bench Press", "desc": "Stable chest/shoulders/elbows; bar path vertically down and up.", "youtube_id": "hWbUlkb5Ms4"},
-        {"key": "deadlift", "name": "Deadlift", "desc": "Flat back; coordinate knees and hips; bar travels close to legs.", "youtube_id": "ZaTM37cfiDs"},
-        {"key": "plank", "name": "Plank", "desc": "Body in a straight line; avoid hips too high or sagging.", "youtube_id": "6LqqeBtFn9M"},
-        {"key": "pullup", "name": "Pull-up", "desc": "Control the rhythm up and down; use assisted variations if needed.", "youtube_id": "eGo4IYlbE5g"},
-        {"key": "lunges", "name": "Lunges", "desc": "Front and back knee at safe angles; front knee not beyond toes.", "youtube_id": "1LuRcKJMn8w"},
-        {"key": "burpee", "name": "Burpee", "desc": "Combine squat, push-up, and jump in a smooth sequence.", "youtube_id": "NCqbpkoiyXE"},
-        {"key": "climbers", "name": "Mountain Climbers", "desc": "Fast and stable pace; use core to control body.", "youtube_id": "cnyTQDSE884"},
-        {"key": "jumprope", "name": "Jump Rope", "desc": "Use wrists to turn rope; light on toes with quick rebounds.", "youtube_id": "wqN5bRkZPK0"},
-        {"key": "rowing", "name": "Rowing Machine", "desc": "Drive sequence: legs → body → arms; recover in reverse order.", "youtube_id": "ZN0J6qKCIrI"},
-    ]
-    return render(request, 'exercises.html', {"items": items})
+    return render(request, 'exercises.html', {"items": _EXERCISES})
 
 
 @login_required
-def ai_planner(request):
+async def ai_planner(request):
     """
     AI Planner view - generates personalized fitness plan based on user profile.
+    Runs as an async view so pending Gemini calls don't hold a worker thread.
     """
-    profile, _ = UserProfile.objects.get_or_create(user=request.user)
+    user = await request.auser()
+    profile = await aget_planner_profile(user)
     result_text = None
     error_text = None
     
     # Check if user has filled in their profile
-    if not profile.gender or not profile.age or not profile.height_cm or not profile.weight_kg:
+    if not profile.profile_complete:
         error_text = "Please complete your profile first (Gender, Age, Height, Weight) before generating a plan. Go to Profile > Edit Profile to update your information."
-        return render(request, 'ai_planner.html', {
+        return await sync_to_async(render)(request, 'ai_planner.html', {
             'profile': profile,
             'result': result_text,
             'error': error_text
         })
     
     if request.method == 'POST':
-        try:
-            # Generate the fitness plan using the AI planner
-            result_text = generate_fitness_plan_from_profile(profile)
-        except Exception as e:
-            error_text = f"An error occurred while generating the plan: {str(e)}"
+        req_id = secrets.token_hex(8)
+        if not await acquire_generation_slot(user.id, req_id):
+            error_text = _PLAN_ALREADY_GENERATING
+        else:
+            # Queue the plan on a Celery worker, which frees the slot; the page polls until it's ready
+            try:
+                task = await sync_to_async(generate_plan_task.delay)(profile.id, user.id, req_id)
+            except Exception:
+                await release_generation_slot(user.id, req_id)
+                raise
+            await request.session.aset('plan_task_id', task.id)
+            return redirect('ai_planner')
+    
+    task_id = await request.session.aget('plan_task_id')
+    if task_id:
+        task = generate_plan_task.AsyncResult(task_id)
+        if await sync_to_async(task.ready)():
+            await request.session.apop('plan_task_id')
+            task_id = None
+            if await sync_to_async(task.successful)():
+                result_text = task.result
+            elif isinstance(task.result, PlanRateLimited):
+                error_text = str(task.result)
+            else:
+                error_text = f"An error occurred while generating the plan: {str(task.result)}"
     
-    return render(request, 'ai_planner.html', {
+    # Templates touch request.user lazily, so render in the sync thread
+    return await sync_to_async(render)(request, 'ai_planner.html', {
         'profile': profile,
         'result': result_text,
-        'error': error_text
+        'error': error_text,
+        'task_id': task_id,
+    })
+
+
+@login_required
+def ai_planner_status(request, task_id):
+    """
+    Reports whether the user's queued plan has finished generating.
+    """
+    if request.session.get('plan_task_id') != task_id:
+        raise Http404("No plan is being generated for this request.")
+    task = generate_plan_task.AsyncResult(task_id)
+    ready = task.ready()
+    return JsonResponse({
+        'ready': ready,
+        'result': task.result if ready and task.successful() else None,
     })
 
+
+def _sse(data, event=None):
+    # One server-sent event; every line of the payload needs its own "data:" prefix
+    lines = [f"event: {event}"] if event else []
+    lines += [f"data: {line}" for line in data.split("\n")]
+    return "\n".join(lines) + "\n\n"
+
+
+@login_required
+async def ai_planner_stream(request):
+    """
+    Streams the AI plan as server-sent events while Gemini generates it.
+    The planner page uses the Celery task instead, so no web worker is tied up for the
+    whole generation; this endpoint is for API clients that want the text as it arrives.
+    """
+    user = await request.auser()
+    profile = await aget_planner_profile(user)
+
+    async def events():
+        req_id = secrets.token_hex(8)
+        if not profile.profile_complete:
+            yield _sse("Please complete your profile first (Gender, Age, Height, Weight) before generating a plan.", event="plan-error")
+        elif not await acquire_generation_slot(user.id, req_id):
+            yield _sse(_PLAN_ALREADY_GENERATING, event="plan-error")
+        else:
+            try:
+                async for text in astream_fitness_plan_from_profile(profile):
+                    yield _sse(text)
+            except PlanRateLimited as e:
+                yield _sse(str(e), event="plan-error")
+            finally:
+                await release_generation_slot(user.id, req_id)
+        yield _sse("", event="done")
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,15 @@
+"""
+Celery config for fittrack project.
+
+Plan generation runs on Celery workers so Django workers aren't held for the Gemini call.
+"""
+
+import os
+
+from celery import Celery
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'fittrack.settings')
+
+app = Celery('fittrack')
+app.config_from_object('django.conf:settings', namespace='CELERY')
+app.autodiscover_tasks()
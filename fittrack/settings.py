@@ -32,6 +32,8 @@ ALLOWED_HOSTS = []
 # Application definition
 
 INSTALLED_APPS = [
+    # Makes runserver serve ASGI, so async views share one event loop
+    'daphne',
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -69,6 +71,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'fittrack.wsgi.application'
+ASGI_APPLICATION = 'fittrack.asgi.application'
 
 
 # Database
@@ -142,3 +145,27 @@ TEMPLATES[0]['OPTIONS']['context_processors'] += [
 ]
 
 STATICFILES_DIRS = [BASE_DIR / 'static']
+
+# Redis holds shared state such as the Gemini rate limiter
+REDIS_URL = os.getenv('REDIS_URL')
+GEMINI_REQUESTS_PER_MINUTE = 20
+
+# Plans allowed to generate at the same time, per user and across the site
+PLAN_GENERATIONS_PER_USER = 1
+PLAN_GENERATIONS_TOTAL = 20
+
+# Share the cache between workers when Redis is configured; otherwise use the local-memory default
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+    CELERY_BROKER_URL = REDIS_URL
+    CELERY_RESULT_BACKEND = REDIS_URL
+else:
+    # Without Redis there is no broker, so run plan tasks inline and keep results in memory
+    CELERY_TASK_ALWAYS_EAGER = True
+    CELERY_TASK_STORE_EAGER_RESULT = True
+    CELERY_RESULT_BACKEND = 'cache+memory://'